@@ -1,260 +1,312 @@
+import copy
+import inspect
 import json
 import boto3
 import logging
 import re
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
 # Logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# boto3 clients
-lex_client = boto3.client("lexv2-models")
-bedrock_client = boto3.client("bedrock-runtime")
+# boto3 clients (connections are kept alive and reused across warm invocations)
+lex_client = boto3.client(
+    "lexv2-models",
+    config=Config(
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": 5},
+        connect_timeout=1,
+        read_timeout=10,
+        max_pool_connections=10,
+    ),
+)
+
+
+# Function to get Bedrock client, created on first use so that cold starts of
+# invocations never invoking the LLM skip loading its service model. Throttled
+# calls are retried by botocore with jittered exponential backoff, and adaptive
+# mode rate limits the client, so a throttled invocation doesn't fail the event
+# and have it retried as a whole
+@lru_cache(maxsize=None)
+def get_bedrock_client():
+    return boto3.client(
+        "bedrock-runtime",
+        config=Config(
+            tcp_keepalive=True,
+            retries={"mode": "adaptive", "max_attempts": 3},
+            read_timeout=60,
+        ),
+    )
 
 
-# Function to get all intents for given bot
-def get_intents(bot_id, bot_version, locale_id):
-    # Populate dictionary of intents for bot
-    all_intents = {}
-    next_token = None
+# Thread pool to issue independent Lex model API calls concurrently
+executor = ThreadPoolExecutor(max_workers=4)
 
-    while True:
-        # Prepare the base request parameters
-        request_params = {
-            "botId": bot_id,
-            "botVersion": bot_version,
-            "localeId": locale_id,
-        }
 
-        # Add nextToken if we have one
-        if next_token:
-            request_params["nextToken"] = next_token
+# Maximum page size of Lex model API list operations
+PAGE_SIZE = 1000
 
-        response = lex_client.list_intents(**request_params)
+# Bot configuration read from Lex is cached across warm invocations
+LEX_CACHE_SIZE = 128
+LEX_CACHE_TTL = 300  # seconds
+_lex_cache = {}
 
-        # Process the current page of results
-        for intent_summary in response["intentSummaries"]:
-            intent_name = intent_summary["intentName"]
-            intent_description = intent_summary["description"]
-            all_intents[intent_name] = intent_description
+# LLM responses are cached across warm invocations, keyed by prompt and model
+LLM_CACHE_SIZE = 256
+LLM_CACHE_TTL = 3600  # seconds
+_llm_cache = {}
 
-        # Check if there are more results
-        next_token = response.get("nextToken")
-        if not next_token:
-            break
+_cache_lock = threading.Lock()
 
-    logger.info(f"All intents for bot are retrieved: {all_intents}")
-    return all_intents
 
+# Decorator to cache results of function in given cache for a limited time, keyed by
+# its arguments or by what the optional key function derives from them
+def _cached(cache, size, ttl, key=None):
+    def decorator(func):
+        signature = inspect.signature(func)
 
-# Function to get all slot types for given intent
-def get_slots(bot_id, bot_version, locale_id, intent):
-    # Search for intent ID of given intent
-    next_token = None
-    intent_id = None
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound_args = signature.bind(*args, **kwargs).args
+            key_args = key(*bound_args) if key else bound_args
+            cache_key = (func.__name__, key_args)
+            now = time.monotonic()
 
-    # Keep searching through pages until we find the intent or run out of results
-    while True:
-        request_params = {
-            "botId": bot_id,
-            "botVersion": bot_version,
-            "localeId": locale_id,
-        }
+            with _cache_lock:
+                entry = cache.get(cache_key)
+            if entry and entry[0] > now:
+                return copy.copy(entry[1])
 
-        if next_token:
-            request_params["nextToken"] = next_token
+            try:
+                result = func(*args, **kwargs)
+            except ClientError as e:
+                # Cached resources have changed, so drop everything cached
+                if e.response["Error"]["Code"] == "ResourceNotFoundException":
+                    with _cache_lock:
+                        cache.clear()
+                raise
 
-        response = lex_client.list_intents(**request_params)
+            # Lookups that failed are not cached, so they are retried next time
+            if result is not None:
+                with _cache_lock:
+                    # Refreshed entry moves to the end, as the newest one
+                    cache.pop(cache_key, None)
+                    if len(cache) >= size:
+                        # Make room by dropping expired entries, or else the oldest one
+                        for expired_key in [
+                            k for k, (expires, _) in cache.items() if expires <= now
+                        ]:
+                            del cache[expired_key]
+                        if len(cache) >= size:
+                            del cache[next(iter(cache))]
+                    cache[cache_key] = (now + ttl, result)
 
-        for intent_summary in response["intentSummaries"]:
-            if intent_summary["intentName"] == intent:
-                intent_id = intent_summary["intentId"]
-                break
+            # Callers get their own copy, as they may modify it
+            return copy.copy(result)
 
-        if intent_id or not response.get("nextToken"):
-            break
+        return wrapper
 
-        next_token = response.get("nextToken")
+    return decorator
 
-    if not intent_id:
-        logger.error(f"Intent '{intent}' not found")
-        return None
 
-    # Populate dictionary of slots for intent
-    all_slots = {}
-    next_token = None
+# Decorator to cache results of function using LLM for as long as LLM responses
+def llm_cached(key=None):
+    return _cached(_llm_cache, LLM_CACHE_SIZE, LLM_CACHE_TTL, key)
 
-    while True:
-        request_params = {
-            "botId": bot_id,
-            "botVersion": bot_version,
-            "localeId": locale_id,
-            "intentId": intent_id,
-        }
 
-        if next_token:
-            request_params["nextToken"] = next_token
+_lex_cached = _cached(_lex_cache, LEX_CACHE_SIZE, LEX_CACHE_TTL)
+_llm_cached = llm_cached()
+
 
-        response = lex_client.list_slots(**request_params)
+# Function to iterate over summaries returned by paginated Lex model API operation
+def _paginate(operation, result_key, **params):
+    params["maxResults"] = PAGE_SIZE
 
-        for slot_summary in response["slotSummaries"]:
-            slot_name = slot_summary["slotName"]
-            all_slots[slot_name] = None
+    while True:
+        response = operation(**params)
+        yield from response[result_key]
 
+        # Check if there are more results
         next_token = response.get("nextToken")
         if not next_token:
-            break
+            return
+        params["nextToken"] = next_token
 
-    logger.info(f"All slots for intent '{intent}' are retrived: {all_slots}")
-    return all_slots
 
+# Function to build mapping of intent names to intent IDs for given bot
+@_lex_cached
+def _build_intent_index(bot_id, bot_version, locale_id):
+    return {
+        intent_name: intent_id
+        for intent_name, _, intent_id in get_intents(bot_id, bot_version, locale_id)
+    }
 
-# Function to get all slot values within given slot type of intent
-def get_slot_values(bot_id, bot_version, locale_id, intent, slot_type):
-    # Search for intent ID of given intent
-    next_token = None
-    intent_id = None
 
-    # Keep searching through pages until we find the intent or run out of results
-    while True:
-        request_params = {
-            "botId": bot_id,
-            "botVersion": bot_version,
-            "localeId": locale_id,
-        }
+# Function to build mapping of slot names to slot IDs, slot type IDs and whether
+# slot type is built-in for given intent
+@_lex_cached
+def _build_slot_index(bot_id, bot_version, locale_id, intent_id):
+    return {
+        slot_summary["slotName"]: (
+            slot_summary["slotId"],
+            slot_summary["slotTypeId"],
+            slot_summary["slotTypeId"].startswith("AMAZON."),
+        )
+        for slot_summary in _paginate(
+            lex_client.list_slots,
+            "slotSummaries",
+            botId=bot_id,
+            botVersion=bot_version,
+            localeId=locale_id,
+            intentId=intent_id,
+        )
+    }
 
-        if next_token:
-            request_params["nextToken"] = next_token
 
-        response = lex_client.list_intents(**request_params)
+# Function to get intent ID of given intent
+def get_intent_id(bot_id, bot_version, locale_id, intent):
+    intent_id = _build_intent_index(bot_id, bot_version, locale_id).get(intent)
 
-        for intent_summary in response["intentSummaries"]:
-            if intent_summary["intentName"] == intent:
-                intent_id = intent_summary["intentId"]
-                break
+    if not intent_id:
+        logger.error("Intent '%s' not found", intent)
+    return intent_id
 
-        if intent_id or not response.get("nextToken"):
-            break
 
-        next_token = response.get("nextToken")
+# Function to get all intents for given bot
+@_lex_cached
+def get_intents(bot_id, bot_version, locale_id):
+    # Populate (name, description, ID) tuples of intents for bot; the result is
+    # immutable, so cached copies are shared between callers
+    all_intents = tuple(
+        (
+            intent_summary["intentName"],
+            intent_summary["description"],
+            intent_summary["intentId"],
+        )
+        for intent_summary in _paginate(
+            lex_client.list_intents,
+            "intentSummaries",
+            botId=bot_id,
+            botVersion=bot_version,
+            localeId=locale_id,
+        )
+    )
 
-    if not intent_id:
-        logger.error(f"Intent '{intent}' not found")
-        return None
+    logger.debug("All intents for bot are retrieved: %s", all_intents)
+    return all_intents
 
-    # Search for slot ID of given slot type
-    next_token = None
-    slot_id = None
 
-    while True:
-        request_params = {
-            "botId": bot_id,
-            "botVersion": bot_version,
-            "localeId": locale_id,
-            "intentId": intent_id,
-        }
+# Function to get all slot types for given intent
+def get_slots(bot_id, bot_version, locale_id, intent, intent_id=None):
+    if not intent_id:
+        intent_id = get_intent_id(bot_id, bot_version, locale_id, intent)
+        if not intent_id:
+            return None
 
-        if next_token:
-            request_params["nextToken"] = next_token
+    # Populate dictionary of slots for intent
+    all_slots = dict.fromkeys(
+        _build_slot_index(bot_id, bot_version, locale_id, intent_id)
+    )
 
-        response = lex_client.list_slots(**request_params)
+    logger.debug("All slots for intent '%s' are retrived: %s", intent, all_slots)
+    return all_slots
 
-        for slot_summary in response["slotSummaries"]:
-            if slot_summary["slotName"] == slot_type:
-                slot_id = slot_summary["slotTypeId"]
-                break
 
-        if slot_id or not response.get("nextToken"):
-            break
+# Function to get all slot values within given slot type of intent
+@_lex_cached
+def get_slot_values(bot_id, bot_version, locale_id, intent_id, slot_type):
+    # Intent ID is resolved by caller, missing intent is already reported there
+    if not intent_id:
+        return None
 
-        next_token = response.get("nextToken")
+    # Search for slot ID of given slot type
+    slot_index = _build_slot_index(bot_id, bot_version, locale_id, intent_id)
 
-    if not slot_id:
-        logger.error(f"Slot type '{slot_type}' not found")
+    if slot_type not in slot_index:
+        logger.error("Slot type '%s' not found", slot_type)
         return None
+    _, slot_type_id, is_builtin = slot_index[slot_type]
 
-    try:
-        # Only try to describe slot type if it's a custom slot (10 char ID)
-        if len(slot_id) <= 10:
-            response = lex_client.describe_slot_type(
-                botId=bot_id,
-                botVersion=bot_version,
-                localeId=locale_id,
-                slotTypeId=slot_id,
-            )
-            all_slot_type_values = []
-
-            # Note: describe_slot_type doesn't use pagination
-            for slot_type_values in response["slotTypeValues"]:
-                all_slot_type_values.append(slot_type_values["sampleValue"]["value"])
+    # Only custom slot types have values to describe
+    if is_builtin:
+        logger.info(
+            "Slot type '%s' is a built-in type, skipping slot assistance", slot_type
+        )
+        return None
 
-            logger.info(
-                f"Slot type values for '{slot_type}' is retrieved: {all_slot_type_values}"
-            )
-            return all_slot_type_values
-        else:
-            logger.info(
-                f"Slot type '{slot_type}' is a built-in type, skipping slot assistance"
-            )
-            return None
+    try:
+        response = lex_client.describe_slot_type(
+            botId=bot_id,
+            botVersion=bot_version,
+            localeId=locale_id,
+            slotTypeId=slot_type_id,
+        )
+        all_slot_type_values = []
+
+        # Note: describe_slot_type doesn't use pagination
+        for slot_type_values in response["slotTypeValues"]:
+            all_slot_type_values.append(slot_type_values["sampleValue"]["value"])
+
+        logger.debug(
+            "Slot type values for '%s' is retrieved: %s",
+            slot_type,
+            all_slot_type_values,
+        )
+        return all_slot_type_values
 
     except Exception as e:
-        logger.error(f"Error describing slot type: {str(e)}")
+        logger.error("Error describing slot type: %s", e)
         return None
 
 
 # Function to set a new slot value within dictionary of slots
 def set_slot(slots, slot_type, input_transcript, updated_slot):
-    new_slot = {
-        slot_type: {
-            "shape": "Scalar",
-            "value": {
-                "originalValue": input_transcript,
-                "resolvedValues": [updated_slot],
-                "interpretedValue": updated_slot,
-            },
-        }
+    slots[slot_type] = {
+        "shape": "Scalar",
+        "value": {
+            "originalValue": input_transcript,
+            "resolvedValues": [updated_slot],
+            "interpretedValue": updated_slot,
+        },
     }
-    slots.update(new_slot)
 
-    logger.info(
-        f"Updated slot type '{slot_type}' with value from '{input_transcript}' to '{updated_slot}'"
+    logger.debug(
+        "Updated slot type '%s' with value from '%s' to '%s'",
+        slot_type,
+        input_transcript,
+        updated_slot,
     )
     return slots
 
 
-# Function to get a slot that is not yet filled
-def get_next_unfilled_slot(bot_id, bot_version, locale_id, intent_name, slots):
-    # Get the intent ID first
-    response = lex_client.list_intents(
+# Function to get slot names of given intent in their defined priority order
+@_lex_cached
+def _ordered_slot_names(bot_id, bot_version, locale_id, intent_id):
+    # Get the complete intent details while all slots are listed
+    intent_response_future = executor.submit(
+        lex_client.describe_intent,
         botId=bot_id,
         botVersion=bot_version,
         localeId=locale_id,
-    )
-    intent_id = None
-    for intent_summary in response["intentSummaries"]:
-        if intent_summary["intentName"] == intent_name:
-            intent_id = intent_summary["intentId"]
-            break
-
-    if not intent_id:
-        logger.error(f"Intent '{intent_name}' not found")
-        return None
-
-    # Get all slots to create a mapping of slotId to slotName
-    slots_response = lex_client.list_slots(
-        botId=bot_id, botVersion=bot_version, localeId=locale_id, intentId=intent_id
+        intentId=intent_id,
     )
 
     # Create a mapping of slot IDs to slot names
     slot_id_to_name = {
-        slot["slotId"]: slot["slotName"] for slot in slots_response["slotSummaries"]
+        slot_id: slot_name
+        for slot_name, (slot_id, _, _) in _build_slot_index(
+            bot_id, bot_version, locale_id, intent_id
+        ).items()
     }
 
     # Get the complete intent details to get slots in priority order
-    intent_response = lex_client.describe_intent(
-        botId=bot_id, botVersion=bot_version, localeId=locale_id, intentId=intent_id
-    )
+    intent_response = intent_response_future.result()
 
     # Get slots in their defined priority order
     slot_priorities = intent_response.get("slotPriorities", [])
@@ -262,17 +314,38 @@ def get_next_unfilled_slot(bot_id, bot_version, locale_id, intent_name, slots):
     # Sort slot priorities by priority number
     sorted_priorities = sorted(slot_priorities, key=lambda x: x["priority"])
 
+    return tuple(slot_id_to_name[priority["slotId"]] for priority in sorted_priorities)
+
+
+# Function to start loading slot priority order of given intent in background, so
+# that a later get_next_unfilled_slot call is served from cache
+def prefetch_slot_order(bot_id, bot_version, locale_id, intent_id):
+    return executor.submit(
+        _ordered_slot_names, bot_id, bot_version, locale_id, intent_id
+    )
+
+
+# Function to get a slot that is not yet filled
+def get_next_unfilled_slot(
+    bot_id, bot_version, locale_id, intent_name, slots, intent_id=None
+):
+    if not intent_id:
+        intent_id = get_intent_id(bot_id, bot_version, locale_id, intent_name)
+        if not intent_id:
+            return None
+
+    slot_order = _ordered_slot_names(bot_id, bot_version, locale_id, intent_id)
+
     # Log the slot order for debugging
-    slot_order = [slot_id_to_name[priority["slotId"]] for priority in sorted_priorities]
-    logger.info(f"Slots in priority order: {slot_order}")
-    logger.info(f"Current slot values: {slots}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Slots in priority order: %s", list(slot_order))
+        logger.debug("Current slot values: %s", slots)
 
     # Check each slot in priority order
-    for priority in sorted_priorities:
-        slot_name = slot_id_to_name[priority["slotId"]]
+    for slot_name in slot_order:
         if slot_name in slots and slots[slot_name] is None:
             logger.info(
-                f"Will elicit slot type '{slot_name}' next based on priority order"
+                "Will elicit slot type '%s' next based on priority order", slot_name
             )
             return slot_name
 
@@ -281,8 +354,9 @@ def get_next_unfilled_slot(bot_id, bot_version, locale_id, intent_name, slots):
 
 
 # Function to invoke LLM on Bedrock
+@_llm_cached
 def invoke_bedrock(prompt, model):
-    logger.info(f"Incoming prompt: {prompt}")
+    logger.debug("Incoming prompt: %s", prompt)
 
     body = json.dumps(
         {
@@ -290,21 +364,33 @@ def invoke_bedrock(prompt, model):
             "max_tokens": 1024,
             "messages": [{"role": "user", "content": prompt}],
             "temperature": 0,
-        }
+        },
+        separators=(",", ":"),
     )
-    response = bedrock_client.invoke_model(body=body, modelId=model)
-    response_body = json.loads(response.get("body").read())
-    answer = response_body.get("content")[0].get("text")
+    response = get_bedrock_client().invoke_model(body=body, modelId=model)
+
+    # Response body is decoded straight from bytes, its schema is fixed
+    response_body = json.loads(response["body"].read())
+    answer = response_body["content"][0]["text"]
 
-    logger.info(f"LLM response: {answer}")
+    logger.info("LLM response: %s", answer)
 
     return answer
 
 
-# Function to extract contents within specified xml tags
-def extract_tag_content(content, tag_name):
-    pattern = f"<{tag_name}>(.*?)</{tag_name}>"
-    match = re.search(pattern, content, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    return None
+# Function to compile pattern matching contents within any of specified xml tags
+@lru_cache(maxsize=None)
+def _tag_pattern(tag_names):
+    return re.compile(
+        "<(%s)>(.*?)</\\1>" % "|".join(map(re.escape, tag_names)), re.DOTALL
+    )
+
+
+# Function to extract contents within each of specified xml tags in a single pass
+def extract_tags(content, *tag_names):
+    contents = {}
+    for match in _tag_pattern(tag_names).finditer(content):
+        contents.setdefault(match.group(1), match.group(2).strip())
+        if len(contents) == len(tag_names):
+            break
+    return tuple(contents.get(tag_name) for tag_name in tag_names)
@@ -1,14 +1,18 @@
 import logging
 import os
 import re
+from concurrent.futures import wait
 from dialog_utils import (
+    get_intent_id,
     get_intents,
     get_slots,
     get_slot_values,
     get_next_unfilled_slot,
+    prefetch_slot_order,
     set_slot,
     invoke_bedrock,
-    extract_tag_content,
+    llm_cached,
+    extract_tags,
 )
 
 # Logging
@@ -17,7 +21,27 @@ logger.setLevel(logging.INFO)
 
 # Constants
 MODEL_ID = os.environ.get("foundation_model")
-logger.info(f"Using foundation model: {MODEL_ID}")
+logger.info("Using foundation model: %s", MODEL_ID)
+NOT_SURE = "NOT SURE"
+
+# Prompt templates (read once per Lambda container)
+PROMPT_DIR = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(PROMPT_DIR, "intent_identification_prompt.txt"), "r") as file:
+    INTENT_IDENTIFICATION_PROMPT = file.read()
+with open(os.path.join(PROMPT_DIR, "slot_assistance_prompt.txt"), "r") as file:
+    SLOT_ASSISTANCE_PROMPT = file.read()
+with open(os.path.join(PROMPT_DIR, "claim_status_prompt.txt"), "r") as file:
+    CLAIM_STATUS_PROMPT = file.read()
+
+# Messages added to responses for voice (audio) interactions
+AUDIO_MESSAGES = {
+    "Damage": "What type of damage occurred to your home?",
+    "PersonalInjury": "Were there any injuries during the incident?",
+    "Damage.Retry": "I didn't catch that. What type of damage occurred to your home?",
+    "PersonalInjury.Retry": "I didn't catch that. Could you please describe any injuries that occurred?",
+    "ReadyForFulfillment": "Thank you for providing those details. I'll help process your claim.",
+    "Delegate": "How can I help you with your claim today?",
+}
 
 # Mock claim status database
 CLAIM_STATUSES = {
@@ -27,347 +51,399 @@ CLAIM_STATUSES = {
     "CLM-456789": "Pending Documentation"
 }
 
+# Plain status responses, used when the LLM response is not confident enough
+CLAIM_FALLBACK_RESPONSES = {
+    claim_number: f"The status of claim {claim_number} is: {status}"
+    for claim_number, status in CLAIM_STATUSES.items()
+}
+
 def validate_claim_number(claim_number):
     """Validate claim number format (CLM-XXXXXX)"""
-    pattern = r'^CLM-\d{6}$'
-    return bool(re.match(pattern, claim_number))
+    return (
+        isinstance(claim_number, str)
+        and len(claim_number) == 10
+        and claim_number.startswith("CLM-")
+        and claim_number[4:].isdecimal()
+    )
+
+def parse_confidence(confidence):
+    """Parse LLM confidence score, treating missing or malformed scores as 0"""
+    try:
+        return float(confidence)
+    except (TypeError, ValueError):
+        return 0.0
 
 def get_claim_status(claim_number):
     """Get status for a claim number"""
     return CLAIM_STATUSES.get(claim_number, "Not Found")
 
+def elicit_slot(intent_name, slots, slot_to_elicit, session_attributes):
+    """Build Lex response eliciting given slot of intent"""
+    return {
+        "sessionState": {
+            "dialogAction": {"type": "ElicitSlot", "slotToElicit": slot_to_elicit},
+            "intent": {"name": intent_name, "slots": slots, "state": "InProgress"},
+            "sessionAttributes": session_attributes,
+        }
+    }
+
+def delegate(intent_name, slots, state, session_attributes):
+    """Build Lex response delegating next dialog action to Lex"""
+    return {
+        "sessionState": {
+            "dialogAction": {"type": "Delegate"},
+            "intent": {"name": intent_name, "slots": slots, "state": state},
+            "sessionAttributes": session_attributes,
+        }
+    }
+
+def elicit_intent(session_attributes):
+    """Build Lex response asking user for their intent after FallbackIntent failed"""
+    return {
+        "sessionState": {
+            "dialogAction": {"type": "ElicitIntent"},
+            "intent": {"name": "FallbackIntent", "state": "Failed"},
+            "sessionAttributes": session_attributes,
+        }
+    }
+
+def add_message(response, content):
+    """Add plain text message to Lex response"""
+    response["messages"] = [{
+        "contentType": "PlainText",
+        "content": content
+    }]
+    return response
+
+def add_audio_message(response, event, message_key):
+    """Add message for voice (audio) interactions to Lex response, if one is defined"""
+    is_audio = event.get("responseContentType", "").startswith("audio/")
+    if is_audio and message_key in AUDIO_MESSAGES:
+        add_message(response, AUDIO_MESSAGES[message_key])
+    return response
+
 def generate_status_response(claim_number, status):
     """Generate natural language response using LLM"""
-    with open("claim_status_prompt.txt", "r") as file:
-        status_prompt = file.read()
-    
+    # Nothing for the LLM to phrase if the claim doesn't exist
+    if status == "Not Found":
+        return f"I couldn't find claim {claim_number}. Please verify the number."
+
     llm_output = invoke_bedrock(
-        status_prompt.format(
+        CLAIM_STATUS_PROMPT.format(
             claim_number=claim_number,
             status=status
         ),
         MODEL_ID,
     )
-    
-    response = extract_tag_content(llm_output, "status_response")
-    confidence = extract_tag_content(llm_output, "confidence_score")
-    
-    return response if float(confidence) >= 0.7 else f"The status of claim {claim_number} is: {status}"
 
+    response, confidence = extract_tags(
+        llm_output, "status_response", "confidence_score"
+    )
 
-def lambda_handler(event, context):
-    logger.info(f"# New Lex event: {event}")
+    if response and parse_confidence(confidence) >= 0.7:
+        return response
+    return CLAIM_FALLBACK_RESPONSES.get(
+        claim_number, f"The status of claim {claim_number} is: {status}"
+    )
+
+def normalize_utterance(utterance):
+    """Normalize user utterance so near-identical phrasings share a cache entry"""
+    return " ".join(re.sub(r"[^\w\s]", "", utterance.lower()).split())
 
+@llm_cached(key=lambda utterance, intents: (normalize_utterance(utterance), intents))
+def identify_intent(utterance, intents):
+    """Identify which of given intents user utterance is about using LLM, None if not confident"""
+    llm_output = invoke_bedrock(
+        INTENT_IDENTIFICATION_PROMPT.format(
+            intents="\n".join(
+                f"- {name}: {description}" if description else f"- {name}"
+                for name, description, _ in intents
+            ),
+            utterance=utterance,
+        ),
+        MODEL_ID,
+    )
+
+    llm_identified_intent, llm_confidence = extract_tags(
+        llm_output, "intent_output", "confidence_score"
+    )
+
+    # Answers other than one of the listed intents are treated as not sure
+    if (
+        llm_identified_intent not in {name for name, _, _ in intents}
+        or parse_confidence(llm_confidence) < 0.7
+    ):
+        return None
+    return llm_identified_intent
+
+
+def handle_fallback_intent(event):
+    """If Lex could not determine user's intent, use LLM to identify the intent"""
     # User input (may not be present in initial request)
     input_transcript = event.get("inputTranscript", "")
 
     # Bot information
-    bot_id = event["bot"]["id"]
-    bot_version = event["bot"]["version"]
-    locale_id = event["bot"]["localeId"]
+    bot = event["bot"]
+    bot_id = bot["id"]
+    bot_version = bot["version"]
+    locale_id = bot["localeId"]
 
-    # Proposed next state
-    proposed_next_state = event.get("proposedNextState", None)
+    session_attributes = event["sessionState"]["sessionAttributes"]
 
-    # Session state
-    session_state = event["sessionState"]
-    intent = session_state["intent"]
-    slots = session_state["intent"]["slots"]
-    session_attributes = session_state["sessionAttributes"]
-    invocation_source = event.get("invocationSource")
+    intents = get_intents(
+        bot_id,
+        bot_version,
+        locale_id,
+    )
+
+    # Listed intents are part of the cache key, so a redeployed bot is classified anew
+    llm_identified_intent = identify_intent(input_transcript, intents)
+
+    # Intent index is built from the intents already listed for the prompt
+    intent_id = llm_identified_intent and get_intent_id(
+        bot_id,
+        bot_version,
+        locale_id,
+        llm_identified_intent,
+    )
 
-    # If Lex could not determine user's intent, use LLM to identify the intent
-    if intent["name"] == "FallbackIntent":
-        intents = get_intents(
+    if intent_id:
+        slots = get_slots(
             bot_id,
             bot_version,
             locale_id,
+            llm_identified_intent,
+            intent_id=intent_id,
+        )
+        next_slot = get_next_unfilled_slot(
+            bot_id=bot_id,
+            bot_version=bot_version,
+            locale_id=locale_id,
+            intent_name=llm_identified_intent,
+            slots=slots,
+            intent_id=intent_id,
         )
 
-        with open("intent_identification_prompt.txt", "r") as file:
-            intent_identification_prompt = file.read()
-        llm_output = invoke_bedrock(
-            intent_identification_prompt.format(
-                intents=intents, utterance=input_transcript
-            ),
-            MODEL_ID,
+        response = elicit_slot(
+            llm_identified_intent, slots, next_slot, session_attributes
+        )
+        return add_audio_message(response, event, "Damage")
+    else:
+        # Always include messages for FallbackIntent to ensure proper voice response
+        return add_message(
+            elicit_intent(session_attributes),
+            "I'm sorry, I didn't understand that. Could you please rephrase your request?"
         )
 
-        llm_identified_intent = extract_tag_content(llm_output, "intent_output")
-        llm_confidence = extract_tag_content(llm_output, "confidence_score")
 
-        if llm_identified_intent.upper() != "NOT SURE" and float(llm_confidence) >= 0.7:
-            slots = get_slots(
-                bot_id,
-                bot_version,
-                locale_id,
-                llm_identified_intent,
-            )
-            next_slot = get_next_unfilled_slot(
-                bot_id=bot_id,
-                bot_version=bot_version,
-                locale_id=locale_id,
-                intent_name=llm_identified_intent,
-                slots=slots
-            )
+def handle_check_claim_status(event):
+    """Handle claim status check"""
+    slots = event["sessionState"]["intent"]["slots"]
+    claim_number = slots.get("ClaimNumber", {}).get("value", {}).get("originalValue")
 
-            response = {
-                "sessionState": {
-                    "dialogAction": {
-                        "type": "ElicitSlot",
-                        "slotToElicit": next_slot,
-                    },
-                    "intent": {
-                        "name": llm_identified_intent,
-                        "slots": slots,
-                        "state": "InProgress",
-                    },
-                    "sessionAttributes": session_attributes,
-                }
-            }
-            if event.get("responseContentType", "").startswith("audio/"):
-                response["messages"] = [{
-                    "contentType": "PlainText",
-                    "content": "What type of damage occurred to your home?"
-                }]
-            return response
-        else:
-            response = {
-                "sessionState": {
-                    "dialogAction": {"type": "ElicitIntent"},
-                    "intent": {"name": "FallbackIntent", "state": "Failed"},
-                    "sessionAttributes": session_attributes,
+    if validate_claim_number(claim_number):
+        status = get_claim_status(claim_number)
+        response = generate_status_response(claim_number, status)
+
+        lex_response = {
+            "sessionState": {
+                "dialogAction": {"type": "Close"},
+                "intent": {
+                    "name": "CheckClaimStatus",
+                    "state": "Fulfilled"
                 }
             }
-            # Always include messages for FallbackIntent to ensure proper voice response
-            response["messages"] = [{
-                "contentType": "PlainText",
-                "content": "I'm sorry, I didn't understand that. Could you please rephrase your request?"
-            }]
-            return response
-
-    # Handle claim status check
-    elif intent["name"] == "CheckClaimStatus":
-        claim_number = slots.get("ClaimNumber", {}).get("value", {}).get("originalValue")
-        
-        if validate_claim_number(claim_number):
-            status = get_claim_status(claim_number)
-            response = generate_status_response(claim_number, status)
-            
-            lex_response = {
-                "sessionState": {
-                    "dialogAction": {"type": "Close"},
-                    "intent": {
-                        "name": "CheckClaimStatus",
-                        "state": "Fulfilled"
-                    }
-                },
-                "messages": [{
-                    "contentType": "PlainText",
-                    "content": response
-                }]
-            }
-            return lex_response
-        else:
-            lex_response = {
-                "sessionState": {
-                    "dialogAction": {
-                        "type": "ElicitSlot",
-                        "slotToElicit": "ClaimNumber"
-                    },
-                    "intent": {
-                        "name": "CheckClaimStatus",
-                        "slots": slots,
-                        "state": "InProgress"
-                    }
+        }
+        return add_message(lex_response, response)
+    else:
+        lex_response = {
+            "sessionState": {
+                "dialogAction": {
+                    "type": "ElicitSlot",
+                    "slotToElicit": "ClaimNumber"
                 },
-                "messages": [{
-                    "contentType": "PlainText",
-                    "content": "Please provide a valid claim number in the format CLM-XXXXXX"
-                }]
+                "intent": {
+                    "name": "CheckClaimStatus",
+                    "slots": slots,
+                    "state": "InProgress"
+                }
             }
-            return lex_response
-            
-    # If user is elicited for slot, use LLM to assist mapping the utterance to slot type values
-    elif invocation_source == "DialogCodeHook":
+        }
+        return add_message(
+            lex_response,
+            "Please provide a valid claim number in the format CLM-XXXXXX"
+        )
+
+
+def handle_dialog_code_hook(event):
+    """If user is elicited for slot, use LLM to assist mapping the utterance to slot type values"""
+    # User input (may not be present in initial request)
+    input_transcript = event.get("inputTranscript", "")
+
+    # Bot information
+    bot = event["bot"]
+    bot_id = bot["id"]
+    bot_version = bot["version"]
+    locale_id = bot["localeId"]
+
+    # Proposed next state
+    proposed_next_state = event.get("proposedNextState", None)
+    proposed_dialog_action = (proposed_next_state or {}).get("dialogAction", {})
+
+    # Session state
+    session_state = event["sessionState"]
+    intent = session_state["intent"]
+    slots = intent["slots"]
+    session_attributes = session_state["sessionAttributes"]
 
     # Get all slots for this intent to determine the first slot
-        all_slots = get_slots(
+    intent_id = get_intent_id(
+        bot_id=bot_id,
+        bot_version=bot_version,
+        locale_id=locale_id,
+        intent=intent["name"]
+    )
+    all_slots = get_slots(
+        bot_id=bot_id,
+        bot_version=bot_version,
+        locale_id=locale_id,
+        intent=intent["name"],
+        intent_id=intent_id
+    )
+    first_slot = next(iter(all_slots)) if all_slots else None
+
+    # Check if this is the initial intent recognition
+    prompt_attempt = (proposed_next_state or {}).get("prompt", {}).get("attempt")
+    is_initial_recognition = (
+        prompt_attempt == "Initial" and
+        not any(slots.values()) and
+        proposed_dialog_action.get("slotToElicit") == first_slot
+    )
+
+    if is_initial_recognition:
+        # Delegate to Lex for the initial intent recognition
+        response = delegate(intent["name"], slots, "InProgress", session_attributes)
+        return add_audio_message(response, event, "Damage")
+
+    transcriptions = event.get("transcriptions", ())
+    is_slot_miss = False
+
+    if transcriptions:
+        resolved_context = transcriptions[0].get("resolvedContext", {})
+        if (resolved_context.get("intent") == "FallbackIntent" or
+            proposed_dialog_action.get("type") == "ElicitSlot"):
+            is_slot_miss = True
+
+    if is_slot_miss and proposed_next_state:
+        # Get the current slot being elicited from proposedNextState
+        current_slot = proposed_dialog_action.get("slotToElicit")
+
+        # Get slot type information to check if it's a custom slot
+        slot_values = get_slot_values(
             bot_id=bot_id,
             bot_version=bot_version,
             locale_id=locale_id,
-            intent=intent["name"]
-        )
-        first_slot = next(iter(all_slots)) if all_slots else None
-
-        # Check if this is the initial intent recognition
-        is_initial_recognition = (
-            proposed_next_state and
-            proposed_next_state.get("prompt", {}).get("attempt") == "Initial" and
-            not any(slot is not None for slot in slots.values()) and
-            proposed_next_state.get("dialogAction", {}).get("slotToElicit") == first_slot
+            intent_id=intent_id,
+            slot_type=current_slot
         )
 
-        if is_initial_recognition:
-            # Delegate to Lex for the initial intent recognition
-            response = {
-                "sessionState": {
-                    "dialogAction": {"type": "Delegate"},
-                    "intent": {
-                        "name": intent["name"],
-                        "slots": slots,
-                        "state": "InProgress"
-                    },
-                    "sessionAttributes": session_attributes,
-                }
-            }
-            if event.get("responseContentType", "").startswith("audio/"):
-                response["messages"] = [{
-                    "contentType": "PlainText",
-                    "content": "What type of damage occurred to your home?"
-                }]
-            return response
-        
-        
-        
-        transcriptions = event.get("transcriptions", [])
-        is_slot_miss = False
-    
-        if transcriptions:
-            resolved_context = transcriptions[0].get("resolvedContext", {})
-            if (resolved_context.get("intent") == "FallbackIntent" or 
-                (proposed_next_state and proposed_next_state.get("dialogAction", {}).get("type") == "ElicitSlot")):
-                is_slot_miss = True
-            
-        if is_slot_miss and proposed_next_state:
-            # Get the current slot being elicited from proposedNextState
-            current_slot = proposed_next_state.get("dialogAction", {}).get("slotToElicit")
-            
-            # Get slot type information to check if it's a custom slot
-            slot_values = get_slot_values(
-                bot_id=bot_id,
-                bot_version=bot_version,
-                locale_id=locale_id,
-                intent=intent["name"],
-                slot_type=current_slot
+        if slot_values:
+            # Load slot priority order while the LLM maps the utterance
+            slot_order = prefetch_slot_order(
+                bot_id, bot_version, locale_id, intent_id
             )
-
-            if slot_values:
-                with open("slot_assistance_prompt.txt", "r") as file:
-                    slot_assistance_prompt = file.read()
+            try:
                 llm_output = invoke_bedrock(
-                    slot_assistance_prompt.format(
-                        slot_values=slot_values, utterance=input_transcript
+                    SLOT_ASSISTANCE_PROMPT.format(
+                        slot_values="\n".join(f"- {value}" for value in slot_values),
+                        utterance=input_transcript,
                     ),
                     MODEL_ID,
                 )
-                llm_mapped_slot = extract_tag_content(llm_output, "slot_output")
-                llm_confidence = extract_tag_content(llm_output, "confidence_score")
-
-                if llm_mapped_slot.upper() != "NOT SURE" and float(llm_confidence) >= 0.7:
-                    slots = set_slot(
-                        slots,
-                        current_slot,
-                        input_transcript,
-                        llm_mapped_slot,
-                    )
+            finally:
+                # Lambda freezes the environment once the handler returns, so the
+                # prefetch must not outlive this invocation
+                wait((slot_order,))
 
-                    next_slot = get_next_unfilled_slot(
-                        bot_id=bot_id,
-                        bot_version=bot_version,
-                        locale_id=locale_id,
-                        intent_name=intent["name"],
-                        slots=slots
-                    )
+            llm_mapped_slot, llm_confidence = extract_tags(
+                llm_output, "slot_output", "confidence_score"
+            )
+
+            if (
+                llm_mapped_slot
+                and llm_mapped_slot.upper() != NOT_SURE
+                and parse_confidence(llm_confidence) >= 0.7
+            ):
+                slots = set_slot(
+                    slots,
+                    current_slot,
+                    input_transcript,
+                    llm_mapped_slot,
+                )
 
-                    if next_slot:
-                        response = {
-                            "sessionState": {
-                                "dialogAction": {
-                                    "type": "ElicitSlot",
-                                    "slotToElicit": next_slot,
-                                },
-                                "intent": {
-                                    "name": intent["name"],
-                                    "slots": slots,
-                                    "state": "InProgress",
-                                },
-                                "sessionAttributes": session_attributes,
-                            }
-                        }
-                        if event.get("responseContentType", "").startswith("audio/"):
-                            if next_slot == "PersonalInjury":
-                                response["messages"] = [{
-                                    "contentType": "PlainText",
-                                    "content": "Were there any injuries during the incident?"
-                                }]
-                            elif next_slot == "Damage":
-                                response["messages"] = [{
-                                    "contentType": "PlainText",
-                                    "content": "What type of damage occurred to your home?"
-                                }]
-                        return response
-                    else:
-                        response = {
-                            "sessionState": {
-                                "dialogAction": {"type": "Delegate"},
-                                "intent": {
-                                    "name": intent["name"],
-                                    "slots": slots,
-                                    "state": "ReadyForFulfillment",
-                                },
-                                "sessionAttributes": session_attributes,
-                            }
-                        }
-                        if event.get("responseContentType", "").startswith("audio/"):
-                            response["messages"] = [{
-                                "contentType": "PlainText",
-                                "content": "Thank you for providing those details. I'll help process your claim."
-                            }]
-                        return response
+                next_slot = get_next_unfilled_slot(
+                    bot_id=bot_id,
+                    bot_version=bot_version,
+                    locale_id=locale_id,
+                    intent_name=intent["name"],
+                    slots=slots,
+                    intent_id=intent_id
+                )
 
+                if next_slot:
+                    response = elicit_slot(
+                        intent["name"], slots, next_slot, session_attributes
+                    )
+                    return add_audio_message(response, event, next_slot)
                 else:
-                    response = {
-                        "sessionState": {
-                            "dialogAction": {
-                                "type": "ElicitSlot",
-                                "slotToElicit": current_slot,
-                            },
-                            "intent": {
-                                "name": intent["name"],
-                                "slots": slots,
-                                "state": "InProgress",
-                            },
-                            "sessionAttributes": session_attributes,
-                        }
-                    }
-                    if event.get("responseContentType", "").startswith("audio/"):
-                        if current_slot == "PersonalInjury":
-                            response["messages"] = [{
-                                "contentType": "PlainText",
-                                "content": "I didn't catch that. Could you please describe any injuries that occurred?"
-                            }]
-                        elif current_slot == "Damage":
-                            response["messages"] = [{
-                                "contentType": "PlainText",
-                                "content": "I didn't catch that. What type of damage occurred to your home?"
-                            }]
-                    return response
+                    response = delegate(
+                        intent["name"], slots, "ReadyForFulfillment", session_attributes
+                    )
+                    return add_audio_message(response, event, "ReadyForFulfillment")
 
-    # For all other cases, delegate to Lex
-    response = {
-        "sessionState": {
-            "dialogAction": {"type": "Delegate"},
-            "intent": {"name": intent["name"], "slots": slots, "state": "InProgress"},
-            "sessionAttributes": session_attributes,
-        }
-    }
+            else:
+                response = elicit_slot(
+                    intent["name"], slots, current_slot, session_attributes
+                )
+                return add_audio_message(response, event, f"{current_slot}.Retry")
+
+    # Nothing to assist with, let Lex continue the dialog
+    return None
+
+
+def delegate_to_lex(event):
+    """Delegate to Lex for all other cases"""
+    session_state = event["sessionState"]
+    intent = session_state["intent"]
+
+    response = delegate(
+        intent["name"],
+        intent["slots"],
+        "InProgress",
+        session_state["sessionAttributes"],
+    )
 
     # Add messages if we need to provide a response
-    if event.get("responseContentType", "").startswith("audio/"):
-        response["messages"] = [{
-            "contentType": "PlainText",
-            "content": "How can I help you with your claim today?"
-        }]
+    return add_audio_message(response, event, "Delegate")
 
-    return response
+
+# Handlers of intents that are always handled by this function
+INTENT_HANDLERS = {
+    "FallbackIntent": handle_fallback_intent,
+    "CheckClaimStatus": handle_check_claim_status,
+}
+
+
+def lambda_handler(event, context):
+    # Skip building the event's repr when info logs are not emitted
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("# New Lex event: %s", event)
+
+    handler = INTENT_HANDLERS.get(event["sessionState"]["intent"]["name"])
+    if handler is None and event.get("invocationSource") == "DialogCodeHook":
+        handler = handle_dialog_code_hook
+
+    response = handler(event) if handler else None
+
+    # For all other cases, delegate to Lex
+    return response or delegate_to_lex(event)